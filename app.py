@@ -1,32 +1,75 @@
 import streamlit as st
-import yfinance as yf
-import pandas as pd
 import numpy as np
-import plotly.graph_objects as go
-from plotly.subplots import make_subplots
-import scipy.optimize
+import logging
+import time
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime
-import json
 
 # ============================================================
 # 📊 Google Sheets 使用者記錄功能
 # ============================================================
+_GSHEETS_SCOPES = [
+    'https://www.googleapis.com/auth/spreadsheets',
+    'https://www.googleapis.com/auth/drive'
+]
+
+@st.cache_resource(show_spinner=False)
+def get_login_sheet():
+    """建立 Google Sheets 連線並開啟記錄用的工作表；整個伺服器行程共用，只在第一次呼叫時授權與開檔"""
+    import gspread
+    from google.oauth2.service_account import Credentials
+
+    # 從 secrets 取得服務帳戶憑證：整段複製一次，除了試算表 ID 其餘都是憑證欄位
+    credentials_dict = dict(st.secrets["gsheets"])
+    spreadsheet_id = credentials_dict.pop("spreadsheet_id")
+    credentials = Credentials.from_service_account_info(credentials_dict, scopes=_GSHEETS_SCOPES)
+    client = gspread.authorize(credentials)
+    # 開啟試算表
+    return client.open_by_key(spreadsheet_id).sheet1
+
+
+@st.cache_resource(show_spinner=False)
+def get_login_writer():
+    """登入記錄在背景寫入，不阻塞頁面；整個伺服器行程共用同一個執行緒池"""
+    return ThreadPoolExecutor(max_workers=2)
+
+
+def write_login_row(sheet, user_email, user_name, now):
+    """更新（或新增）使用者的登入記錄；回傳更新的列號，新使用者回傳 None"""
+    # 檢查使用者是否已存在：一次讀回 A:E，在本地找 email 所在列並取得登入次數，
+    # 取代 find + cell 兩次往返
+    rows = sheet.get('A:E')
+    row = next((i for i, r in enumerate(rows, start=1) if r and r[0] == user_email), None)
+    if row:
+        # 使用者存在，最後登入時間（D）和登入次數（E）一次寫入
+        values = rows[row - 1]
+        current_count = int(values[4] if len(values) > 4 and values[4] else 0)
+        sheet.batch_update([{'range': f'D{row}:E{row}', 'values': [[now, current_count + 1]]}], value_input_option='USER_ENTERED')
+    else:
+        # 新使用者，新增一列
+        sheet.append_row([user_email, user_name, now, now, 1])
+    return row
+
+
+def log_login_error(future):
+    """背景寫入沒有 Streamlit 畫面可顯示，失敗時改寫到伺服器 log"""
+    if future.exception() is not None:
+        logging.getLogger(__name__).warning("Google Sheets 登入記錄失敗: %s", future.exception())
+
+
 def record_user_login(debug=False):
     """記錄使用者登入到 Google Sheets
     
     Args:
-        debug: 如果為 True，會在側邊欄顯示除錯訊息
+        debug: 如果為 True，會在側邊欄顯示除錯訊息，並同步寫入以便顯示結果
     """
+    # 檢查是否已記錄過（避免每次 rerun 都記錄），在任何匯入或連線前就先返回
+    if st.session_state.get('user_recorded', False):
+        if debug:
+            st.sidebar.success("✅ 使用者已記錄過")
+        return
+
     try:
-        import gspread
-        from google.oauth2.service_account import Credentials
-        
-        # 檢查是否已記錄過（避免每次 rerun 都記錄）
-        if st.session_state.get('user_recorded', False):
-            if debug:
-                st.sidebar.success("✅ 使用者已記錄過")
-            return
-        
         # 從 secrets 讀取 Google Sheets 設定
         if 'gsheets' not in st.secrets:
             if debug:
@@ -36,62 +79,24 @@ def record_user_login(debug=False):
         if debug:
             st.sidebar.info("🔄 正在連接 Google Sheets...")
         
-        # 設定憑證
-        scopes = [
-            'https://www.googleapis.com/auth/spreadsheets',
-            'https://www.googleapis.com/auth/drive'
-        ]
-        
-        # 從 secrets 取得服務帳戶憑證
-        credentials_dict = {
-            "type": st.secrets["gsheets"]["type"],
-            "project_id": st.secrets["gsheets"]["project_id"],
-            "private_key_id": st.secrets["gsheets"]["private_key_id"],
-            "private_key": st.secrets["gsheets"]["private_key"],
-            "client_email": st.secrets["gsheets"]["client_email"],
-            "client_id": st.secrets["gsheets"]["client_id"],
-            "auth_uri": st.secrets["gsheets"]["auth_uri"],
-            "token_uri": st.secrets["gsheets"]["token_uri"],
-            "auth_provider_x509_cert_url": st.secrets["gsheets"]["auth_provider_x509_cert_url"],
-            "client_x509_cert_url": st.secrets["gsheets"]["client_x509_cert_url"]
-        }
-        
-        credentials = Credentials.from_service_account_info(credentials_dict, scopes=scopes)
-        client = gspread.authorize(credentials)
+        # 連線與工作表由 get_login_sheet 快取，之後的登入不必再授權、開檔
+        sheet = get_login_sheet()
         
-        if debug:
-            st.sidebar.info("🔄 正在開啟試算表...")
-        
-        # 開啟試算表
-        spreadsheet_id = st.secrets["gsheets"]["spreadsheet_id"]
-        sheet = client.open_by_key(spreadsheet_id).sheet1
-        
-        # 取得使用者資訊
+        # 取得使用者資訊（st.user 只能在主執行緒讀取）
         user_email = getattr(st.user, 'email', 'unknown')
         user_name = getattr(st.user, 'name', '') or user_email
-        now = datetime.now().strftime('%Y-%m-%d %H:%M:%S')
+        now = time.strftime('%Y-%m-%d %H:%M:%S')
         
         if debug:
             st.sidebar.info(f"🔄 使用者: {user_email}")
-        
-        # 檢查使用者是否已存在（新版 gspread 的 find 返回 None 而非拋出例外）
-        cell = sheet.find(user_email, in_column=1)
-        if cell:
-            # 使用者存在，更新最後登入時間和登入次數
-            row = cell.row
-            current_count = int(sheet.cell(row, 5).value or 0)
-            sheet.update_cell(row, 4, now)  # 更新最後登入時間
-            sheet.update_cell(row, 5, current_count + 1)  # 更新登入次數
-            if debug:
-                st.sidebar.success(f"✅ 已更新使用者記錄（第 {row} 列）")
+            row = write_login_row(sheet, user_email, user_name, now)
+            st.sidebar.success(f"✅ 已更新使用者記錄（第 {row} 列）" if row else "✅ 已新增使用者記錄")
+            st.session_state.user_recorded = True
         else:
-            # 新使用者，新增一列
-            sheet.append_row([user_email, user_name, now, now, 1])
-            if debug:
-                st.sidebar.success("✅ 已新增使用者記錄")
-        
-        # 標記已記錄
-        st.session_state.user_recorded = True
+            # 讀寫試算表交給背景執行緒，頁面不必等 Google API 往返；
+            # 送出前先標記已記錄，避免接下來的 rerun 重複送出
+            st.session_state.user_recorded = True
+            get_login_writer().submit(write_login_row, sheet, user_email, user_name, now).add_done_callback(log_login_error)
         
     except Exception as e:
         # 顯示錯誤訊息以便除錯
@@ -99,23 +104,185 @@ def record_user_login(debug=False):
             st.sidebar.error(f"❌ Google Sheets 錯誤: {str(e)}")
 
 
-def xirr(cash_flows):
+def xirr(dates, amounts):
+    """以平行的日期與金額序列計算 XIRR（投入為負、提領/終值為正）"""
+    from scipy.optimize import brentq  # 延後匯入：登入頁面用不到 scipy
+    if len(dates) < 2: return 0.0
+    # 陣列只在進入時建立一次，不在每次迭代重建
+    amounts = np.asarray(amounts, dtype=np.float64)
+    # 現金流沒有同時出現正負號時 NPV 不會有根，直接略過求解
+    if not ((amounts > 0).any() and (amounts < 0).any()): return 0.0
+    dates64 = np.asarray(dates, dtype='datetime64[D]')
+    years = (dates64 - dates64.min()).astype(np.float64) / 365.0
+    amounts_years = amounts * years
+    # npv/dnpv 接受純量或陣列的 rate（陣列用於多起點 Newton）；rate <= -1 時無定義
+    def discount(rate):
+        rate = np.asarray(rate, dtype=np.float64)
+        valid = rate > -1.0
+        safe = np.where(valid, rate, 0.0)
+        return valid, safe, np.exp(-np.log1p(safe)[..., None] * years)
+    def npv(rate):
+        valid, _, disc = discount(rate)
+        return np.where(valid, disc @ amounts, np.inf)
+    def dnpv(rate):
+        # d/dr (1+r)^-y = -y/(1+r) * (1+r)^-y，沿用同一組折現因子
+        valid, safe, disc = discount(rate)
+        return np.where(valid, -(disc @ amounts_years) / (1 + safe), np.inf)
+    lo, hi = -0.99, 10.0
     try:
-        dates, amounts = zip(*cash_flows)
-        if len(dates) < 2: return 0.0
-        min_date = min(dates)
-        days = [(d - min_date).days for d in dates]
-        def npv(rate):
-            if rate <= -1.0: return float('inf')
-            return np.sum(np.array(amounts) / np.power(1 + rate, np.array(days) / 365.0))
-        try:
-            result = scipy.optimize.newton(npv, 0.1, maxiter=50)
-            # Optimization #2: Cap XIRR to reasonable range
-            return max(-1.0, min(10.0, result))  # -100% to +1000%
-        except:
-            return 0.0
-    except:
+        if npv(lo) * npv(hi) < 0:
+            # NPV 在上下限之間變號：Brent 法保證收斂
+            result = brentq(npv, lo, hi, xtol=1e-7, maxiter=50)
+        else:
+            # 找不到變號區間：從多個起點同時以向量化 Newton 迭代，取收斂且 |NPV| 最小的根
+            # （直接寫迴圈，省去 scipy.optimize.newton 每步的參數檢查與簿記開銷）
+            roots = np.array([0.01, 0.05, 0.1, 0.2, 0.5])
+            converged = np.zeros(len(roots), dtype=bool)
+            with np.errstate(all='ignore'):
+                for _ in range(50):
+                    f, fp = npv(roots), dnpv(roots)
+                    # 已收斂、導數為零或已跑出定義域（NPV 為 inf）的起點不再更新
+                    active = ~converged & (fp != 0) & np.isfinite(f) & np.isfinite(fp)
+                    if not active.any(): break
+                    step = np.where(active, f / np.where(active, fp, 1.0), 0.0)
+                    roots = roots - step
+                    converged |= active & (np.abs(step) < 1e-7)
+            roots = roots[converged & np.isfinite(roots) & (roots > -1.0)]
+            if len(roots) == 0: return 0.0
+            result = roots[np.argmin(np.abs(npv(roots)))]
+    except (RuntimeError, ValueError):
+        # brentq 無法收斂
         return 0.0
+    # Optimization #2: Cap XIRR to reasonable range
+    return max(-1.0, min(10.0, float(result)))  # -100% to +1000%
+
+# ============================================================
+# 📈 回測模擬
+# ============================================================
+def simulate_portfolio(asset_close, asset_open, is_month_start, is_year_start, is_jan_start, weights, is_cash0,
+                       initial_capital, monthly_investment, enable_rebalance,
+                       w_enabled=False, w_rate=0.04, w_inf=0.02, w_start=1):
+    """模擬單一投資組合（價格矩陣為交易日 × 資產，CASH0 的價格為 0）。
+    回傳每日市值、累計投入、當日提領三個陣列，現金流（含期末市值）的交易日序號與金額，以及總提領金額"""
+    n_days, n_a = asset_close.shape
+    # 提領、再平衡、買進都只發生在月初（年初必定也是月初），其餘交易日持股不變；
+    # 因此只逐月處理這些事件，記下每個月初處理完後的狀態，每日市值最後再一次向量化算出
+    month_idx = np.flatnonzero(is_month_start)
+    n_months = len(month_idx)
+    cash_account = float(initial_capital)
+    # 持股以陣列存放（每個資產一列），估值與買進都是向量運算，不再逐一走訪 dict
+    shares, cash_asset = np.zeros(n_a), np.zeros(n_a)
+    total_invested = float(initial_capital)
+    shares_m, cash_m, inv_m = np.empty((n_months, n_a)), np.empty(n_months), np.empty(n_months)
+    wd_hist = np.zeros(n_days)
+    # 現金流預先配置：期初 + 每個月初最多一筆提領與一筆定期投入 + 期末，以計數器寫入
+    flow_idx, flow_amts, nf = np.empty(2 * n_months + 2, dtype=np.int64), np.empty(2 * n_months + 2), 0
+    if initial_capital > 0:
+        flow_idx[nf], flow_amts[nf] = 0, -initial_capital; nf += 1
+    yr_cnt, ann_budg, cum_wd = 0, 0, 0
+
+    for k, i in enumerate(month_idx):
+        close_row, open_row = asset_close[i], asset_open[i]
+        if is_year_start[i]:
+            if i > 0:
+                yr_cnt += 1
+                if ann_budg > 0: ann_budg *= (1 + w_inf)
+            if w_enabled and (yr_cnt + 1) >= w_start and ann_budg == 0:
+                val = cash_account + cash_asset.sum() + shares @ close_row
+                ann_budg = val * w_rate
+
+        todays_wd = 0
+
+        if w_enabled and ann_budg > 0:
+            tgt = ann_budg / 12.0
+            if cash_account >= tgt:
+                cash_account -= tgt
+                todays_wd = tgt
+            else:
+                need = tgt - cash_account
+                todays_wd += cash_account
+                cash_account = 0
+                for j in range(n_a):
+                    if need <= 0: break
+                    val_base = cash_asset[j]
+                    if val_base >= need:
+                        cash_asset[j] -= need
+                        todays_wd += need
+                        need = 0
+                    else:
+                        need -= val_base
+                        todays_wd += val_base
+                        cash_asset[j] = 0
+                        px = open_row[j]
+                        if px>0:
+                            s_need = need / px
+                            max_sell = int(shares[j])
+                            sell = min(int(np.ceil(s_need)), max_sell)
+                            if sell > 0:
+                                proceeds = sell * px
+                                shares[j] -= sell
+                                if proceeds >= need:
+                                    cash_account += (proceeds - need)
+                                    todays_wd += need
+                                    need = 0
+                                else:
+                                    todays_wd += proceeds
+                                    need -= proceeds
+            cum_wd += todays_wd
+            wd_hist[i] = todays_wd
+            if todays_wd > 0:
+                flow_idx[nf], flow_amts[nf] = i, todays_wd; nf += 1
+
+        # Optimization #4: Skip rebalance in first year (yr_cnt must be > 0)
+        if is_jan_start[i] and enable_rebalance and yr_cnt > 0:
+            cur_vals = np.where(is_cash0, cash_asset, shares * open_row)
+            tot_pv = cash_account + cur_vals.sum()
+            diff = cur_vals - tot_pv * weights
+            # 賣出超配：每個資產只看自己的差額，整批向量化（股票取整股，現金部位直接轉回現金帳戶）
+            over = diff > 0
+            cash_sell = np.where(over & is_cash0, np.minimum(diff, cash_asset), 0.0)
+            n_sell = np.floor(np.divide(diff, open_row, out=np.zeros(n_a), where=over & (open_row > 0)))
+            cash_asset -= cash_sell
+            shares -= n_sell
+            cash_account += cash_sell.sum() + n_sell @ open_row
+            # 買進低配：依序花用賣出後的現金，前一個資產買完剩多少會影響下一個，必須逐一處理
+            for j in np.flatnonzero(diff < 0):
+                if is_cash0[j]:
+                    amt = min(-diff[j], cash_account)
+                    cash_asset[j] += amt
+                    cash_account -= amt
+                elif open_row[j] > 0:
+                    amt = min(-diff[j], cash_account)
+                    n = int(amt / open_row[j])
+                    if n > 0:
+                        shares[j] += n
+                        cash_account -= n * open_row[j]
+
+        if monthly_investment > 0:
+            cash_account += monthly_investment
+            total_invested += monthly_investment
+            flow_idx[nf], flow_amts[nf] = i, -monthly_investment; nf += 1
+        cash_asset += cash_account * weights
+        cash_account = 0
+        buyable = open_row > 0
+        n = np.floor_divide(cash_asset, open_row, out=np.zeros(n_a), where=buyable)
+        n = np.maximum(n, 0)
+        shares += n
+        cash_asset -= n * open_row
+
+        shares_m[k], cash_m[k], inv_m[k] = shares, cash_account + cash_asset.sum(), total_invested
+
+    # 每個交易日沿用當月月初處理後的持股與現金，一次算出整段每日市值；
+    # 逐資產（最多 10 檔）累加，不必把持股展開成「交易日 × 資產」的暫存矩陣
+    month_of_day = np.cumsum(is_month_start) - 1
+    pv_hist = cash_m[month_of_day]
+    for j in range(n_a):
+        pv_hist += asset_close[:, j] * shares_m[month_of_day, j]
+    inv_hist = inv_m[month_of_day]
+    # 期末市值視為最後一天的正現金流
+    if n_days and pv_hist[-1] > 0:
+        flow_idx[nf], flow_amts[nf] = n_days - 1, pv_hist[-1]; nf += 1
+    return pv_hist, inv_hist, wd_hist, flow_idx[:nf], flow_amts[:nf], cum_wd
 
 # ============================================================
 # 🚀 應用程式入口
@@ -125,10 +292,8 @@ st.set_page_config(page_title="金雞計算機Galculator+", page_icon="🐔", la
 # ============================================================
 # 🔐 使用 Streamlit 原生 OIDC 認證 (Google OAuth)
 # ============================================================
-# 檢查是否已登入
-if not st.user.is_logged_in:
-    # 顯示登入頁面
-    st.markdown("""
+# 登入頁面的樣式與標誌（靜態字串，無需每次 rerun 組字串）
+_LOGIN_HTML = """
     <style>
     .login-container {
         display: flex;
@@ -151,17 +316,10 @@ if not st.user.is_logged_in:
         <div class="login-title">金雞計算機</div>
         <div class="login-subtitle">Galculator+ 投資回測工具</div>
     </div>
-    """, unsafe_allow_html=True)
-    
-    col1, col2, col3 = st.columns([1, 2, 1])
-    with col2:
-        st.button("🔐 使用 Google 帳號登入", on_click=st.login, use_container_width=True, type="primary")
-        
-        # 隱私權說明
-        st.caption("🔒 登入即表示您同意我們的隱私權政策")
-        
-        with st.expander("📋 隱私權說明", expanded=False):
-            st.markdown("""
+    """
+
+# 隱私權說明（同樣是靜態字串）
+_PRIVACY_MD = """
             **我們收集的資料：**
             - 您的 Google 帳號 Email
             - 您的 Google 帳號顯示名稱
@@ -180,7 +338,22 @@ if not st.user.is_logged_in:
             - 您可隨時要求查看、更正或刪除您的個人資料
             - 如需退訂行銷郵件，請點擊郵件中的取消訂閱連結
             - 如有疑問，請聯繫：https://lin.ee/hTsvz68
-            """)
+            """
+
+# 檢查是否已登入
+if not st.user.is_logged_in:
+    # 顯示登入頁面
+    st.markdown(_LOGIN_HTML, unsafe_allow_html=True)
+    
+    col1, col2, col3 = st.columns([1, 2, 1])
+    with col2:
+        st.button("🔐 使用 Google 帳號登入", on_click=st.login, use_container_width=True, type="primary")
+        
+        # 隱私權說明
+        st.caption("🔒 登入即表示您同意我們的隱私權政策")
+        
+        with st.expander("📋 隱私權說明", expanded=False):
+            st.markdown(_PRIVACY_MD)
     st.stop()
 
 # ============================================================
@@ -189,6 +362,12 @@ if not st.user.is_logged_in:
 # 記錄使用者到 Google Sheets
 record_user_login()
 
+# 資料與繪圖套件只有登入後才用得到，延後到這裡匯入以加快登入頁面的冷啟動
+import yfinance as yf
+import pandas as pd
+import plotly.graph_objects as go
+from plotly.subplots import make_subplots
+
 def show_user_sidebar():
     """在側邊欄顯示使用者資訊"""
     with st.sidebar:
@@ -246,20 +425,27 @@ with st.sidebar:
 
     selected_portfolio_idx = st.selectbox("選擇編輯的投資組合", range(len(st.session_state.portfolios)), format_func=lambda i: st.session_state.portfolios[i]['name'])
 
+    # 新增/複製/刪除用 on_click 回呼：回呼在重新執行前就改好 portfolios，不必再額外 st.rerun() 跑一次整個腳本
+    def add_portfolio():
+        if len(st.session_state.portfolios) < 10:
+            st.session_state.portfolios.append({"name": f"組合 {len(st.session_state.portfolios)+1}", "assets": [{"ticker": "QQQ", "weight": 100}], "withdrawal_enabled": False, "w_rate": 4.0, "w_inflation": 2.0, "w_start_year": 1})
+
+    def copy_portfolio(idx):
+        if len(st.session_state.portfolios) < 10:
+            src = st.session_state.portfolios[idx]
+            st.session_state.portfolios.append({"name": src["name"] + " (副本)", "assets": [{"ticker": a["ticker"], "weight": a["weight"]} for a in src["assets"]], "withdrawal_enabled": src.get("withdrawal_enabled", False), "w_rate": src.get("w_rate", 4.0), "w_inflation": src.get("w_inflation", 2.0), "w_start_year": src.get("w_start_year", 1)})
+
+    def delete_portfolio(idx):
+        if len(st.session_state.portfolios) > 1:
+            st.session_state.portfolios.pop(idx)
+
     col_p1, col_p2, col_p3 = st.columns(3)
     with col_p1:
-        if st.button("➕ 新增組合") and len(st.session_state.portfolios) < 10:
-            st.session_state.portfolios.append({"name": f"組合 {len(st.session_state.portfolios)+1}", "assets": [{"ticker": "QQQ", "weight": 100}], "withdrawal_enabled": False, "w_rate": 4.0, "w_inflation": 2.0, "w_start_year": 1})
-            st.rerun()
+        st.button("➕ 新增組合", on_click=add_portfolio)
     with col_p2:
-        if st.button("©️ 複製組合") and len(st.session_state.portfolios) < 10:
-            src = st.session_state.portfolios[selected_portfolio_idx]
-            st.session_state.portfolios.append({"name": src["name"] + " (副本)", "assets": [{"ticker": a["ticker"], "weight": a["weight"]} for a in src["assets"]], "withdrawal_enabled": src.get("withdrawal_enabled", False), "w_rate": src.get("w_rate", 4.0), "w_inflation": src.get("w_inflation", 2.0), "w_start_year": src.get("w_start_year", 1)})
-            st.rerun()
+        st.button("©️ 複製組合", on_click=copy_portfolio, args=(selected_portfolio_idx,))
     with col_p3:
-        if st.button("➖ 刪除組合") and len(st.session_state.portfolios) > 1:
-            st.session_state.portfolios.pop(selected_portfolio_idx)
-            st.rerun()
+        st.button("➖ 刪除組合", on_click=delete_portfolio, args=(selected_portfolio_idx,))
 
     if selected_portfolio_idx >= len(st.session_state.portfolios):
         selected_portfolio_idx = len(st.session_state.portfolios) - 1
@@ -309,36 +495,72 @@ with st.sidebar:
     can_run = weight_ok and date_ok
     run_backtest = st.button("🚀 開始計算", type="primary", disabled=not can_run, use_container_width=True)
 
-@st.cache_data
+class PartialDownload(Exception):
+    """部分代碼整欄沒有價格：帶著已下載的資料與缺資料的代碼拋出，讓結果不寫入快取"""
+    def __init__(self, data, missing):
+        super().__init__(", ".join(missing))
+        self.data, self.missing = data, missing
+
+@st.cache_data(persist="disk", max_entries=200, show_spinner=False)
+def download_prices(tickers, start, end):
+    """下載股價並持久化到磁碟快取，伺服器重啟後同樣的查詢不必再連 Yahoo"""
+    data = yf.download(list(tickers), start=start, end=end, progress=False, threads=True, auto_adjust=False)
+    if data is None or len(data) == 0:
+        # 空結果多半是暫時性的連線/限流問題，用例外跳過快取，下次重新下載
+        raise LookupError("無資料")
+    # 回測只用到開盤、收盤、還原收盤，High/Low/Volume 先丟掉，縮小快取與後續 ffill 的資料量
+    # （單一代碼的平面欄位也適用：get_level_values(0) 就是欄位名本身）
+    data = data.loc[:, data.columns.get_level_values(0).isin(['Open', 'Close', 'Adj Close'])]
+    # 單一代碼下載失敗（例如被限流）時 yfinance 不會報錯，只會讓該代碼整欄為 NaN；
+    # 這種不完整的結果不能寫入快取，否則之後每次都會默默少掉那個代碼
+    fields = data.columns.get_level_values(0)
+    field = 'Adj Close' if 'Adj Close' in fields else 'Close' if 'Close' in fields else None
+    if field is None:
+        missing = list(tickers)
+    else:
+        prices = data[field]
+        prices = prices.reindex(columns=list(tickers)) if isinstance(prices, pd.DataFrame) else prices.to_frame()
+        missing = [t for t, empty in zip(tickers, prices.isna().all()) if empty]
+    if missing:
+        raise PartialDownload(data, missing)
+    return data
+
 def fetch_data(tickers, start, end):
+    # 排序後當作快取鍵，避免 set 順序不同造成重複下載
+    tickers = sorted(set(tickers))
     try:
-        data = yf.download(list(set(tickers)), start=start, end=end, progress=False)
-        return data, None, list(set(tickers))
+        return download_prices(tuple(tickers), start, end), None, tickers
+    except PartialDownload as e:
+        # 這次照常用已下載的資料回測（不進快取），缺資料的代碼之後由 first_valid 篩掉
+        st.warning(f"⚠️ 以下代碼查無股價資料，將略過：{e}")
+        return e.data, None, tickers
+    except LookupError:
+        return None, None, tickers
     except Exception as e:
         return None, str(e), []
 
-def get_stock_data(df, dt, ticker):
-    try:
-        def get_val(col):
-            if isinstance(df.columns, pd.MultiIndex):
-                if (col, ticker) in df.columns:
-                    val = df.loc[dt, (col, ticker)]
-                    return val if not pd.isna(val) else float('nan')
-            else:
-                if col in df.columns:
-                    val = df.loc[dt, col]
-                    return val if not pd.isna(val) else float('nan')
-            return float('nan')
-        p_open, p_close, p_adj_close = get_val('Open'), get_val('Close'), get_val('Adj Close')
-        if pd.isna(p_adj_close): p_adj_close = p_close if not pd.isna(p_close) else p_open
-        p_adj_open = p_open
-        if not pd.isna(p_open) and not pd.isna(p_close) and not pd.isna(p_adj_close) and p_close != 0:
-            p_adj_open = p_open * (p_adj_close / p_close)
-        elif pd.isna(p_open):
-            p_adj_open = p_adj_close
-        return {'adj_close': 0.0 if pd.isna(p_adj_close) else float(p_adj_close), 'adj_open': 0.0 if pd.isna(p_adj_open) else float(p_adj_open)}
-    except:
-        return {'adj_close': 0.0, 'adj_open': 0.0}
+def build_price_matrices(df, tickers):
+    """一次算出所有代碼的還原收盤價/還原開盤價矩陣（交易日 × 代碼），缺值以 0 表示"""
+    n_days, n_tickers = len(df), len(tickers)
+    def get_field(col):
+        if isinstance(df.columns, pd.MultiIndex):
+            if col in df.columns.get_level_values(0):
+                return df[col].reindex(columns=tickers).to_numpy(dtype=np.float64)
+        elif col in df.columns:
+            return np.repeat(df[col].to_numpy(dtype=np.float64)[:, None], n_tickers, axis=1)
+        return np.full((n_days, n_tickers), np.nan)
+    p_open, p_close, p_adj_close = get_field('Open'), get_field('Close'), get_field('Adj Close')
+    p_adj_close = np.where(np.isnan(p_adj_close), np.where(np.isnan(p_close), p_open, p_close), p_adj_close)
+    # 開盤價依收盤價的還原比例調整；沒有開盤價時以還原收盤價代替
+    has_ratio = ~np.isnan(p_open) & ~np.isnan(p_close) & ~np.isnan(p_adj_close) & (p_close != 0)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        p_adj_open = np.where(has_ratio, p_open * (p_adj_close / p_close), np.where(np.isnan(p_open), p_adj_close, p_open))
+    return np.where(np.isnan(p_adj_close), 0.0, p_adj_close), np.where(np.isnan(p_adj_open), 0.0, p_adj_open)
+
+# 輸入與上次計算完全相同時直接沿用既有結果（含圖表），不重跑回測、也不重建 Plotly 物件
+backtest_key = (repr(st.session_state.portfolios), start_date, end_date, initial_capital, monthly_investment, enable_rebalance)
+if run_backtest and st.session_state.get('results') and st.session_state.get('results_key') == backtest_key:
+    run_backtest = False
 
 if run_backtest:
     all_tickers = set()
@@ -366,22 +588,19 @@ if run_backtest:
                 st.session_state.results = None
             else:
                 market_data = market_data.ffill()
-                # Optimization: Reuse already collected tickers set
-                all_active_tickers = set(all_tickers)
-                
-                valid_starts, debug_info = [], {}
-                for t in all_active_tickers:
-                    try:
-                        if isinstance(market_data.columns, pd.MultiIndex):
-                            if ('Adj Close', t) in market_data.columns: fvi = market_data[('Adj Close', t)].first_valid_index()
-                            elif ('Close', t) in market_data.columns: fvi = market_data[('Close', t)].first_valid_index()
-                            else: fvi = None
-                        else:
-                            fvi = market_data['Adj Close'].first_valid_index() if 'Adj Close' in market_data.columns else None
-                        if fvi: 
-                            valid_starts.append(fvi)
-                            debug_info[t] = fvi.strftime('%Y-%m-%d')
-                    except: pass
+                # 各代碼第一個有價格的交易日一次算出：對整張價格表做 notna 後取每欄第一個 True
+                if isinstance(market_data.columns, pd.MultiIndex):
+                    fields = market_data.columns.get_level_values(0)
+                    field = 'Adj Close' if 'Adj Close' in fields else 'Close' if 'Close' in fields else None
+                    first_prices = market_data[field].reindex(columns=all_tickers) if field else pd.DataFrame(index=market_data.index)
+                elif 'Adj Close' in market_data.columns:
+                    first_prices = pd.DataFrame({t: market_data['Adj Close'] for t in all_tickers})
+                else:
+                    first_prices = pd.DataFrame(index=market_data.index)
+                has_price = first_prices.notna()
+                first_valid = has_price.idxmax()[has_price.any()]
+                valid_starts = first_valid.tolist()
+                debug_info = {t: d.strftime('%Y-%m-%d') for t, d in first_valid.items()}
                 
                 # Optimization: Fix crash if no valid data found
                 if not valid_starts:
@@ -395,166 +614,53 @@ if run_backtest:
                 color_palette = ['#636EFA', '#EF553B', '#00CC96', '#AB63FA', '#FFA15A', '#19D3F3', '#FF6692', '#B6E880', '#FF97FF', '#FECB52']
                 portfolio_idx = 0
                 figs = make_subplots(rows=2, cols=1, shared_xaxes=True, vertical_spacing=0.08, row_heights=[0.7, 0.3], subplot_titles=("資產成長趨勢", "年度報酬率 (%)"))
+                # 回測期間、價格矩陣與月初/年初遮罩和個別組合無關，迴圈外只算一次
+                in_range = market_data.index >= common_start
+                dates = market_data.index[in_range]
+                # 價格一次整理成矩陣，迴圈內以整數位置取值，不再逐日做 .loc 查詢
+                adj_close, adj_open = build_price_matrices(market_data[in_range], all_tickers)
+                ticker_col = {t: j for j, t in enumerate(all_tickers)}
+                # 月初（買進/提領日）、年初、一月初（再平衡日）一次算好，迴圈內以位置查表
+                months, years = dates.month.to_numpy(), dates.year.to_numpy()
+                is_month_start = np.r_[True, months[1:] != months[:-1]]
+                is_year_start = np.r_[True, years[1:] != years[:-1]]
+                is_jan_start = is_month_start & (months == 1)
 
                 for p in st.session_state.portfolios:
-                    dates = market_data.index[market_data.index >= common_start]
-                    if len(dates) == 0: continue
-                    
-                    cash_account = float(initial_capital)
-                    holdings = {a['ticker']: {'shares': 0.0, 'cash_asset_currency': 0.0} for a in p['assets']}
-                    alloc_map = {a['ticker']: a['weight']/100.0 for a in p['assets']}
-                    total_invested = float(initial_capital)
-                    history, xirr_flows = [], []
-                    if initial_capital > 0: xirr_flows.append((dates[0], -initial_capital))
-                    
-                    w_enabled = p.get('withdrawal_enabled', False)
-                    w_rate = p.get('w_rate', 4.0) / 100.0
-                    w_inf = p.get('w_inflation', 2.0) / 100.0
-                    w_start = int(p.get('w_start_year', 1))
-                    curr_yr, yr_cnt, ann_budg, cum_wd, prev_mo = -1, 0, 0, 0, -1
-                    
-                    for d in dates:
-                        if d.year != curr_yr:
-                            if curr_yr != -1:
-                                yr_cnt += 1
-                                if ann_budg > 0: ann_budg *= (1 + w_inf)
-                            curr_yr = d.year
-                            if w_enabled and (yr_cnt + 1) >= w_start and ann_budg == 0:
-                                val = cash_account
-                                for t,h in holdings.items():
-                                    if t == 'CASH0': val += h['cash_asset_currency']
-                                    else:
-                                        pr = get_stock_data(market_data, d, t)
-                                        val += (h['shares'] * pr['adj_close']) + h['cash_asset_currency']
-                                ann_budg = val * w_rate
-                        
-                        is_buy = (d.month != prev_mo)
-                        if is_buy: prev_mo = d.month
-                        todays_wd = 0
-                        
-                        if is_buy and w_enabled and ann_budg > 0:
-                            tgt = ann_budg / 12.0
-                            if cash_account >= tgt:
-                                cash_account -= tgt
-                                todays_wd = tgt
-                            else:
-                                need = tgt - cash_account
-                                todays_wd += cash_account
-                                cash_account = 0
-                                for t,h in holdings.items():
-                                    if need <= 0: break
-                                    pr = get_stock_data(market_data, d, t)
-                                    val_base = h['cash_asset_currency']
-                                    if val_base >= need:
-                                        h['cash_asset_currency'] -= need
-                                        todays_wd += need
-                                        need = 0
-                                    else:
-                                        need -= val_base
-                                        todays_wd += val_base
-                                        h['cash_asset_currency'] = 0
-                                        if t!='CASH0' and pr['adj_open']>0:
-                                            s_need = need / pr['adj_open']
-                                            max_sell = int(h['shares'])
-                                            sell = min(int(np.ceil(s_need)), max_sell)
-                                            if sell > 0:
-                                                proceeds = sell * pr['adj_open']
-                                                h['shares'] -= sell
-                                                if proceeds >= need:
-                                                    cash_account += (proceeds - need)
-                                                    todays_wd += need
-                                                    need = 0
-                                                else:
-                                                    todays_wd += proceeds
-                                                    need -= proceeds
-                            cum_wd += todays_wd
-                            if todays_wd > 0: xirr_flows.append((d, todays_wd))
-                        
-                        # Optimization #4: Skip rebalance in first year (yr_cnt must be > 0)
-                        if is_buy and enable_rebalance and d.month == 1 and yr_cnt > 0:
-                            cur_vals, tot_pv, rebal_prs = {}, cash_account, {}
-                            for t,h in holdings.items():
-                                if t=='CASH0': 
-                                    cur_vals[t] = h['cash_asset_currency']
-                                    tot_pv += h['cash_asset_currency']
-                                else:
-                                    pr = get_stock_data(market_data, d, t)
-                                    rebal_prs[t] = pr['adj_open']
-                                    cur_vals[t] = h['shares'] * pr['adj_open']
-                                    tot_pv += cur_vals[t]
-                            
-                            for t in holdings:
-                                diff = cur_vals[t] - tot_pv * alloc_map[t]
-                                if diff > 0:
-                                    if t=='CASH0':
-                                        amt = min(diff, holdings[t]['cash_asset_currency'])
-                                        holdings[t]['cash_asset_currency'] -= amt
-                                        cash_account += amt
-                                    elif rebal_prs.get(t, 0) > 0:
-                                        n = int(diff / rebal_prs[t])
-                                        if n > 0:
-                                            holdings[t]['shares'] -= n
-                                            cash_account += n * rebal_prs[t]
-                            for t in holdings:
-                                diff = tot_pv * alloc_map[t] - cur_vals[t]
-                                if diff > 0:
-                                    if t=='CASH0':
-                                        amt = min(diff, cash_account)
-                                        holdings[t]['cash_asset_currency'] += amt
-                                        cash_account -= amt
-                                    elif rebal_prs.get(t, 0) > 0:
-                                        amt = min(diff, cash_account)
-                                        n = int(amt / rebal_prs[t])
-                                        if n > 0:
-                                            holdings[t]['shares'] += n
-                                            cash_account -= n * rebal_prs[t]
-
-                        if is_buy:
-                            if monthly_investment > 0:
-                                cash_account += monthly_investment
-                                total_invested += monthly_investment
-                                xirr_flows.append((d, -monthly_investment))
-                            pot = cash_account
-                            cash_account = 0
-                            for t,h in holdings.items():
-                                amt = pot * alloc_map[t]
-                                h['cash_asset_currency'] += amt
-                                if t!='CASH0':
-                                    pr = get_stock_data(market_data, d, t)
-                                    if pr['adj_open'] > 0:
-                                        n = int(h['cash_asset_currency'] // pr['adj_open'])
-                                        if n > 0:
-                                            h['shares'] += n
-                                            h['cash_asset_currency'] -= n * pr['adj_open']
-                        
-                        pv = cash_account
-                        for t,h in holdings.items():
-                            if t=='CASH0': pv += h['cash_asset_currency']
-                            else:
-                                pr = get_stock_data(market_data, d, t)
-                                pv += (h['shares'] * pr['adj_close']) + h['cash_asset_currency']
-                        history.append({'Date': d, 'Total Value': pv, 'Invested Capital': total_invested, 'Withdrawal': todays_wd})
-                    
-                    df_res = pd.DataFrame(history).set_index('Date')
+                    # 現金部位的價格一律視為 0，估值時只計入 cash_asset
+                    is_cash0 = np.array([a['ticker'] == 'CASH0' for a in p['assets']])
+                    asset_cols = [ticker_col.get(a['ticker'], 0) for a in p['assets']]
+                    asset_close = np.where(is_cash0, 0.0, adj_close[:, asset_cols])
+                    asset_open = np.where(is_cash0, 0.0, adj_open[:, asset_cols])
+                    weights = np.array([a['weight']/100.0 for a in p['assets']])
+                    pv_hist, inv_hist, wd_hist, flow_idx, flow_amts, cum_wd = simulate_portfolio(
+                        asset_close, asset_open, is_month_start, is_year_start, is_jan_start, weights, is_cash0,
+                        initial_capital, monthly_investment, enable_rebalance,
+                        w_enabled=p.get('withdrawal_enabled', False),
+                        w_rate=p.get('w_rate', 4.0) / 100.0,
+                        w_inf=p.get('w_inflation', 2.0) / 100.0,
+                        w_start=int(p.get('w_start_year', 1)))
+                    total_invested = inv_hist[-1]
+                    df_res = pd.DataFrame({'Total Value': pv_hist, 'Invested Capital': inv_hist, 'Withdrawal': wd_hist}, index=dates.rename('Date'))
                     if not df_res.empty:
-                        final_v = df_res['Total Value'].iloc[-1]
-                        if final_v > 0: xirr_flows.append((dates[-1], final_v))
-                        yr_diff = (df_res.index[-1] - df_res.index[0]).days / 365.25
-                        dur_str = f"{yr_diff:.1f} 年 ({df_res.index[0].strftime('%Y-%m')} ~ {df_res.index[-1].strftime('%Y-%m')})"
+                        final_v = pv_hist[-1]
+                        yr_diff = (dates[-1] - dates[0]).days / 365.25
+                        dur_str = f"{yr_diff:.1f} 年 ({dates[0].strftime('%Y-%m')} ~ {dates[-1].strftime('%Y-%m')})"
                         
-                        # MDD with detailed timing
-                        roll_max = df_res['Total Value'].cummax()
-                        dd = (df_res['Total Value'] - roll_max) / roll_max
-                        mdd = dd.min()
+                        # MDD with detailed timing（整段在 NumPy 陣列上完成，以位置回查日期）
+                        roll_max = np.maximum.accumulate(pv_hist)
+                        # 高點為 0（尚未投入）的日子沒有回撤可言，視為 0
+                        dd = np.divide(pv_hist - roll_max, roll_max, out=np.zeros_like(pv_hist), where=roll_max > 0)
+                        i_mdd = int(dd.argmin())
+                        mdd = dd[i_mdd]
                         if mdd < 0:
-                            mdd_date = dd.idxmin()
+                            mdd_date = dates[i_mdd]
                             # Find peak date before MDD
-                            peak_date = roll_max[:mdd_date].idxmax()
+                            peak_date = dates[roll_max[:i_mdd+1].argmax()]
                             # Find recovery date (if any)
-                            post_mdd = df_res.loc[mdd_date:, 'Total Value']
-                            recovery_mask = post_mdd >= roll_max[mdd_date]
-                            if recovery_mask.any():
-                                recovery_date = post_mdd[recovery_mask].index[0]
+                            recovered = pv_hist[i_mdd:] >= roll_max[i_mdd]
+                            if recovered.any():
+                                recovery_date = dates[i_mdd + recovered.argmax()]
                                 recovery_days = (recovery_date - mdd_date).days
                                 mdd_str = f"{mdd*100:.2f}% (📉{peak_date.strftime('%Y-%m')} → 📍{mdd_date.strftime('%Y-%m')} → 📈{recovery_date.strftime('%Y-%m')}, 回復{recovery_days}天)"
                             else:
@@ -562,34 +668,28 @@ if run_backtest:
                         else:
                             mdd_str = "0.00%"
 
-                        results_list.append({"組合名稱": p['name'], "回測時間": dur_str, "總投入本金": total_invested, "資產終值": final_v, "總提領金額": cum_wd, "總損益": (final_v + cum_wd) - total_invested, "XIRR": f"{xirr(xirr_flows)*100:.2f}%", "MDD": mdd_str})
+                        results_list.append({"組合名稱": p['name'], "回測時間": dur_str, "總投入本金": total_invested, "資產終值": final_v, "總提領金額": cum_wd, "總損益": (final_v + cum_wd) - total_invested, "XIRR": f"{xirr(dates[flow_idx], flow_amts)*100:.2f}%", "MDD": mdd_str})
                         
                         try: monthly_dfs[p['name']] = df_res.resample('ME').agg({'Total Value':'last', 'Invested Capital':'last', 'Withdrawal':'sum'})
                         except: monthly_dfs[p['name']] = df_res.resample('M').agg({'Total Value':'last', 'Invested Capital':'last', 'Withdrawal':'sum'})
                         
                         # Use consistent color for this portfolio
                         port_color = color_palette[portfolio_idx % len(color_palette)]
-                        figs.add_trace(go.Scatter(x=df_res.index, y=df_res['Total Value'], mode='lines', name=f"{p['name']} (市值)", line=dict(color=port_color)), row=1, col=1)
-                        wd_pts = df_res[df_res['Withdrawal'] > 0]
-                        if not wd_pts.empty:
-                            figs.add_trace(go.Scatter(x=wd_pts.index, y=wd_pts['Total Value'], mode='markers', marker=dict(size=5,color='red'), showlegend=False), row=1, col=1)
-
-                        years = sorted(df_res.index.year.unique())
-                        ann_ret_x, ann_ret_y, ann_ret_labels = [], [], {}
-                        
-                        for i, y in enumerate(years):
-                            df_y = df_res[df_res.index.year == y]
-                            if df_y.empty: continue
-                            end_val = df_y['Total Value'].iloc[-1]
-                            if i == 0:
-                                start_val = df_y['Total Value'].iloc[0]
-                            else:
-                                df_prev = df_res[df_res.index.year == years[i-1]]
-                                start_val = df_prev['Total Value'].iloc[-1] if not df_prev.empty else df_y['Total Value'].iloc[0]
-                            ret = (end_val / start_val) - 1 if start_val > 0 else 0
-                            ann_ret_x.append(datetime(y, 7, 1))
-                            ann_ret_y.append(ret * 100)  # Convert to percentage
-                            ann_ret_labels[y] = ret
+                        figs.add_trace(go.Scattergl(x=dates, y=pv_hist, mode='lines', name=f"{p['name']} (市值)", line=dict(color=port_color)), row=1, col=1)
+                        wd_mask = wd_hist > 0
+                        if wd_mask.any():
+                            figs.add_trace(go.Scattergl(x=dates[wd_mask], y=pv_hist[wd_mask], mode='markers', marker=dict(size=5,color='red'), showlegend=False), row=1, col=1)
+
+                        # 年報酬：由年初遮罩直接得到各年第一天與最後一天的位置，
+                        # 起始值用前一年最後一天的值（第一年用當年第一天）
+                        year_first = np.flatnonzero(is_year_start)
+                        year_last = np.r_[year_first[1:] - 1, len(dates) - 1]
+                        end_val = pv_hist[year_last]
+                        start_val = np.r_[pv_hist[year_first[0]], end_val[:-1]]
+                        ann_ret = np.where(start_val > 0, end_val / np.where(start_val > 0, start_val, 1.0) - 1, 0.0)
+                        ann_ret_x = [datetime(y, 7, 1) for y in years[year_first]]
+                        ann_ret_y = (ann_ret * 100).tolist()  # Convert to percentage
+                        ann_ret_labels = dict(zip(years[year_first].tolist(), ann_ret.tolist()))
 
                         # Use same color as the line chart for this portfolio
                         figs.add_trace(go.Bar(x=ann_ret_x, y=ann_ret_y, name=f"{p['name']} (年報酬%)", marker_color=port_color, opacity=0.7), row=2, col=1)
@@ -599,6 +699,7 @@ if run_backtest:
                 figs.update_xaxes(dtick="M12", tickformat="%Y")
                 figs.update_yaxes(ticksuffix="%", row=2, col=1)  # Add % suffix to Y-axis
                 st.session_state.results = {'summary': results_list, 'monthly_data': monthly_dfs, 'annual_returns': annual_returns_data, 'fig': figs, 'common_start': common_start, 'debug': debug_info}
+                st.session_state.results_key = backtest_key
 
 if st.session_state.get('results'):
     res = st.session_state.results